@@ -1,21 +1,66 @@
 # Streamlit App: GoldCore Competitor Price Comparison (Per-Oz Basis)
 import streamlit as st
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+import lxml.html
+from lxml import etree
 import re
+import threading
+import time
 from io import BytesIO
 
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+PARSE_WORKERS = 4
+# Concurrent connections to any single site, so no one competitor is hammered.
+MAX_PER_HOST = 4
+# Product prices sit near the top of the page; stop downloading after this many bytes
+# once a pound sign has been seen, and after MAX_BODY_BYTES_EXTENDED regardless.
+MAX_BODY_BYTES = 131_072
+MAX_BODY_BYTES_EXTENDED = 524_288
+POUND_MARKERS = (b"\xa3", b"&pound;", b"&#163;")
+# Dead or non-HTML URLs are detected with a short HEAD request before the full GET.
+# Only socket time counts, so waiting for a free pooled connection never fails a probe.
+PROBE_TIMEOUT = aiohttp.ClientTimeout(sock_connect=3, sock_read=3)
+# Scraped prices are reused across reruns for this many seconds.
+PRICE_CACHE_TTL = 1800
 
-# --- Helper: Extract quantity of coins mentioned in text ---
-def extract_quantity(text: str) -> int:
-    patterns = [
+PRICE_RE = re.compile(r"£\s*((?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d{2})?)")
+VAT_RE = re.compile("vat", re.I)
+
+# Holds one HTML parser and one set of compiled XPath selectors per parse worker;
+# lxml serialises calls that share a parser or a compiled XPath object.
+THREAD_LOCAL = threading.local()
+
+# Elements whose class or id mentions "price" (case-insensitive).
+PRICE_NODES_XPATH = (
+    "//*[contains(translate(@class, 'PRICE', 'price'), 'price')"
+    " or contains(translate(@id, 'PRICE', 'price'), 'price')]"
+)
+# Visible body text, used only when no price element matched.
+BODY_TEXT_XPATH = "//body//text()[not(ancestor::script or ancestor::style)]"
+# Product heading text, where pack sizes such as "Tube of 25" are stated.
+HEADING_TEXT_XPATH = "//title//text() | //h1//text()"
+
+# Bounds on the full-text fallback scan when no price container matched.
+MAX_TEXT_SCAN = 200_000
+MAX_PRICE_CANDIDATES = 50
+
+QTY_PATTERNS = [
+    re.compile(p, re.I)
+    for p in (
         r"(\d{1,3})\s*(?:coins?|pcs|pieces|units)",
         r"(?:pack|tube|box|monster box|roll)[^\d]{0,10}(\d{1,3})",
         r"x\s?(\d{1,3})",
-    ]
-    for pat in patterns:
-        m = re.search(pat, text, re.I)
+    )
+]
+
+
+# --- Helper: Extract quantity of coins mentioned in text ---
+def extract_quantity(text: str) -> int:
+    for pat in QTY_PATTERNS:
+        m = pat.search(text)
         if m:
             try:
                 qty = int(m.group(1))
@@ -26,53 +71,127 @@ def extract_quantity(text: str) -> int:
     return 1
 
 
+# --- Helper: Check a URL is live and serves HTML ---
+async def probe(session: aiohttp.ClientSession, url: str) -> bool:
+    try:
+        async with session.head(url, allow_redirects=True, timeout=PROBE_TIMEOUT) as r:
+            # Some servers don't implement HEAD; leave those to the GET.
+            if r.status in (405, 501):
+                return True
+            if r.status >= 400:
+                return False
+            content_type = r.headers.get("Content-Type", "").lower()
+            return not content_type or content_type.startswith("text/html")
+    except Exception:
+        return False
+
+
+# --- Helper: Fetch a single page body ---
+async def fetch(session: aiohttp.ClientSession, url: str):
+    """Return the leading part of the response body for url, or None if the request fails."""
+    if not await probe(session, url):
+        return None
+    try:
+        async with session.get(url) as r:
+            body = bytearray()
+            async for chunk in r.content.iter_chunked(16_384):
+                body += chunk
+                if len(body) >= MAX_BODY_BYTES_EXTENDED:
+                    break
+                if len(body) >= MAX_BODY_BYTES:
+                    # Stop once a pound sign has arrived and the text node holding it has closed.
+                    pound = max(body.rfind(m) for m in POUND_MARKERS)
+                    if pound != -1 and body.find(b"<", pound) != -1:
+                        break
+            else:
+                return bytes(body)
+            # Cut back to the last complete tag so a half-read price is never scanned.
+            return bytes(body[:body.rfind(b">", 0, MAX_BODY_BYTES_EXTENDED) + 1])
+    except Exception:
+        return None
+
+
+# --- Helper: Return this thread's HTML parser ---
+def get_html_parser():
+    parser = getattr(THREAD_LOCAL, "html_parser", None)
+    if parser is None:
+        parser = THREAD_LOCAL.html_parser = lxml.html.HTMLParser(remove_comments=True)
+    return parser
+
+
+# --- Helper: Return this thread's compiled copy of an XPath expression ---
+def get_xpath(expr: str):
+    xpaths = getattr(THREAD_LOCAL, "xpaths", None)
+    if xpaths is None:
+        xpaths = THREAD_LOCAL.xpaths = {}
+    xpath = xpaths.get(expr)
+    if xpath is None:
+        xpath = xpaths[expr] = etree.XPath(expr)
+    return xpath
+
+
+# --- Helper: Yield (price, has_vat) candidates found on a page ---
+def iter_price_candidates(tree, check_vat: bool = True):
+    found = False
+    for el in get_xpath(PRICE_NODES_XPATH)(tree):
+        t = el.text_content()
+        match = PRICE_RE.search(t)
+        if match:
+            found = True
+            p = float(match.group(1).replace(",", ""))
+            has_vat = check_vat and VAT_RE.search(t) is not None
+            yield p, has_vat
+
+    # Price containers are authoritative; only scan the page text if none matched.
+    if found:
+        return
+
+    text = " ".join(filter(None, (t.strip() for t in get_xpath(BODY_TEXT_XPATH)(tree))))
+    if "£" not in text:
+        return
+
+    for n, m in enumerate(PRICE_RE.finditer(text, 0, MAX_TEXT_SCAN), 1):
+        p = float(m.group(1).replace(",", ""))
+        # Look for "vat" within 30 chars either side, searching in place rather than slicing.
+        has_vat = check_vat and VAT_RE.search(text, max(m.start() - 30, 0), m.end() + 30) is not None
+        yield p, has_vat
+        if n >= MAX_PRICE_CANDIDATES:
+            return
+
+
 # --- Helper: Extract price (and quantity) from a page ---
-def extract_price_info(url: str, prefer_vat: bool = False):
+def parse_price(html, prefer_vat: bool = False):
     """Return tuple of (price, quantity). Price is total price; divide by quantity for per-coin."""
+    if html is None:
+        return None, 1
     try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        r = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(r.content, "html.parser")
-
-        text = soup.get_text(" ", strip=True)
-        price_regex = re.compile(r"£\s*((?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d{2})?)")
-
-        candidates = []
-        for tag in soup.find_all(True, {"class": re.compile("price", re.I), "id": re.compile("price", re.I)}):
-            match = price_regex.search(tag.get_text())
-            if match:
-                p = float(match.group(1).replace(",", ""))
-                has_vat = "vat" in tag.get_text().lower()
-                candidates.append((p, has_vat))
-
-        for m in price_regex.finditer(text):
-            p = float(m.group(1).replace(",", ""))
-            start = max(m.start() - 30, 0)
-            end = min(m.end() + 30, len(text))
-            snippet = text[start:end].lower()
-            has_vat = "vat" in snippet
-            candidates.append((p, has_vat))
-
-        if not candidates:
-            return None, 1
+        # Always parse as a full document; fromstring() would sniff for fragments first.
+        tree = lxml.html.document_fromstring(html, parser=get_html_parser())
 
-        if prefer_vat:
-            vat_prices = [p for p, vat in candidates if vat]
-            if vat_prices:
-                price = max(vat_prices)
-            else:
-                price = max(p for p, _ in candidates)
-        else:
-            price = min(p for p, _ in candidates)
+        price = None
+        vat_price = None
+        for p, has_vat in iter_price_candidates(tree, check_vat=prefer_vat):
+            if prefer_vat:
+                if has_vat and (vat_price is None or p > vat_price):
+                    vat_price = p
+                if price is None or p > price:
+                    price = p
+            elif price is None or p < price:
+                price = p
+
+        if prefer_vat and vat_price is not None:
+            price = vat_price
+        if price is None:
+            return None, 1
 
-        quantity = extract_quantity(text)
+        quantity = extract_quantity(" ".join(get_xpath(HEADING_TEXT_XPATH)(tree)))
         return price, quantity
     except Exception:
         return None, 1
 
 # --- Helper: Wrapper returning only price per coin ---
-def extract_price_from_url(url, prefer_vat=False):
-    price, qty = extract_price_info(url, prefer_vat=prefer_vat)
+def extract_price_per_coin(html, prefer_vat=False):
+    price, qty = parse_price(html, prefer_vat=prefer_vat)
     if price is None:
         return None
     try:
@@ -80,6 +199,99 @@ def extract_price_from_url(url, prefer_vat=False):
     except Exception:
         return price
 
+
+# --- Helper: Fetch and parse all jobs concurrently ---
+async def scrape_all(phases, on_progress=None):
+    """Return dict mapping each (url, prefer_vat) job to its per-coin price (None on failure).
+
+    phases is a list of job lists fetched one after another, so that GoldCore pages
+    finish before the competitor pages start.
+    """
+    batches = []
+    for jobs in phases:
+        vats_by_url = {}
+        for url, vat in jobs:
+            vats_by_url.setdefault(url, []).append(vat)
+        batches.append(vats_by_url)
+    total = sum(map(len, batches))
+
+    loop = asyncio.get_running_loop()
+    prices = {}
+    # One pooled session per run: sockets stay open between requests to the same host.
+    connector = aiohttp.TCPConnector(
+        limit=20, limit_per_host=MAX_PER_HOST, keepalive_timeout=30, ttl_dns_cache=300
+    )
+    # Only socket time counts: requests queued behind MAX_PER_HOST must not time out while waiting.
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=10)
+    with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+        async with aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout) as session:
+
+            async def scrape(url, vats):
+                body = await fetch(session, url)
+                # Parsing blocks, so run it on the pool while other fetches are still in flight.
+                for vat in vats:
+                    prices[(url, vat)] = await loop.run_in_executor(pool, extract_price_per_coin, body, vat)
+
+            done = 0
+            for vats_by_url in batches:
+                tasks = [scrape(url, vats) for url, vats in vats_by_url.items()]
+                for task in asyncio.as_completed(tasks):
+                    await task
+                    done += 1
+                    if on_progress:
+                        on_progress(done / total)
+    return prices
+
+
+# --- Helper: Process-wide store of scraped prices, shared across reruns and sessions ---
+@st.cache_resource
+def price_cache():
+    """Return dict mapping (url, prefer_vat) to (scraped_at, price)."""
+    return {}
+
+
+# --- Helper: Scrape per-coin prices for phases of (url, prefer_vat) jobs, reusing recent results ---
+def scrape_prices(*phases):
+    """Return dict mapping each (url, prefer_vat) job to its per-coin price (None on failure)."""
+    cache = price_cache()
+    now = time.time()
+    prices = {}
+    # Each distinct job is scraped once, in the first phase that lists it.
+    seen = set()
+    misses = []
+    for jobs in phases:
+        phase_misses = []
+        for job in jobs:
+            if job in seen:
+                continue
+            seen.add(job)
+            hit = cache.get(job)
+            if hit and now - hit[0] < PRICE_CACHE_TTL:
+                prices[job] = hit[1]
+            else:
+                phase_misses.append(job)
+        misses.append(phase_misses)
+
+    if any(misses):
+        progress = st.progress(0.0)
+        fresh = asyncio.run(scrape_all(misses, on_progress=progress.progress))
+        # The store is shared by every session, so drop expired entries before adding more.
+        expired = [job for job, (scraped_at, _) in list(cache.items()) if now - scraped_at >= PRICE_CACHE_TTL]
+        for job in expired:
+            cache.pop(job, None)
+        # Failures are not cached so that a flaky page is retried on the next run.
+        cache.update((job, (now, price)) for job, price in fresh.items() if price is not None)
+        prices.update(fresh)
+    return prices
+
+
+# --- Helper: Read the uploaded sheet, cached on its contents ---
+@st.cache_data(ttl=PRICE_CACHE_TTL, max_entries=16, show_spinner=False)
+def load_sheet(data: bytes, name: str) -> pd.DataFrame:
+    if name.lower().endswith((".xlsx", ".xls")):
+        return pd.read_excel(BytesIO(data))
+    return pd.read_csv(BytesIO(data))
+
 # --- Streamlit UI ---
 st.set_page_config(page_title="GoldCore Price Comparison", layout="wide")
 st.title("🟡 GoldCore vs Competitors – Live Price Comparison")
@@ -100,50 +312,74 @@ All prices must be in GBP (£).
 uploaded = st.file_uploader("Upload CSV or Excel", type=["csv", "xlsx", "xls"])
 
 if uploaded:
-    if uploaded.name.lower().endswith((".xlsx", ".xls")):
-        df = pd.read_excel(uploaded)
-    else:
-        df = pd.read_csv(uploaded)
+    df = load_sheet(uploaded.getvalue(), uploaded.name)
     st.success("File uploaded!")
 
-    results = []
-    st.info("Scraping live prices... please wait.")
+    results = {
+        "Product": [],
+        "GoldCore Price (£)": [],
+        "Competitor Price (£)": [],
+        "GoldCore URL": [],
+        "Competitor URL": [],
+    }
 
+    products = []
     for col in df.columns:
         urls = df[col].dropna().tolist()
         if len(urls) < 2:
             continue
-
         product = col.strip()
-        gc_url = urls[1]
-        competitor_urls = urls[2:]
+        products.append((product, urls[1], urls[2:], "silver" in product.lower()))
 
-        st.write(f"🔎 Scraping: **{product}**")
-        gc_price = extract_price_from_url(gc_url)
+    # One status placeholder and one summary warning rather than a message per product.
+    status = st.empty()
+    status.info(f"Scraping live prices for {len(products)} products... please wait.")
+
+    # GoldCore pages first, then competitors, so each phase keeps reusing the same hosts.
+    gc_jobs = [(gc_url, False) for _, gc_url, _, _ in products]
+    comp_jobs = [
+        (comp_url, use_vat)
+        for _, _, competitor_urls, use_vat in products
+        for comp_url in competitor_urls
+    ]
+    prices = scrape_prices(gc_jobs, comp_jobs)
+    status.write(f"🔎 Scraped {len(products)} products")
+
+    missing = []
+    for product, gc_url, competitor_urls, use_vat in products:
+        gc_price = prices[(gc_url, False)]
 
         if not gc_price:
-            st.warning(f"❌ Could not extract GoldCore price for {product}")
+            missing.append(product)
             continue
 
-        use_vat = "silver" in product.lower()
         for comp_url in competitor_urls:
-            comp_price = extract_price_from_url(comp_url, prefer_vat=use_vat)
-            results.append({
-                "Product": product,
-                "GoldCore Price (£)": gc_price,
-                "Competitor Price (£)": comp_price,
-                "Difference (£)": round(comp_price - gc_price, 2) if comp_price else None,
-                "% Difference": round(((comp_price - gc_price) / gc_price) * 100, 2) if comp_price else None,
-                "GoldCore URL": gc_url,
-                "Competitor URL": comp_url
-            })
-
-    if results:
+            comp_price = prices[(comp_url, use_vat)]
+            results["Product"].append(product)
+            results["GoldCore Price (£)"].append(gc_price)
+            results["Competitor Price (£)"].append(comp_price)
+            results["GoldCore URL"].append(gc_url)
+            results["Competitor URL"].append(comp_url)
+
+    if missing:
+        st.warning(f"❌ Could not extract GoldCore price for {', '.join(missing)}")
+
+    if results["Product"]:
         df_out = pd.DataFrame(results)
+        gc_prices = df_out["GoldCore Price (£)"]
+        # Missing (or zero) competitor prices become NaN, which propagates to both differences.
+        comp_prices = df_out["Competitor Price (£)"].astype(float)
+        comp_prices = comp_prices.where(comp_prices != 0)
+        diff = comp_prices - gc_prices
+        df_out.insert(3, "Difference (£)", diff.round(2))
+        df_out.insert(4, "% Difference", (diff / gc_prices * 100).round(2))
+        # Product and URL values repeat across rows; store each distinct string once.
+        for col in ("Product", "GoldCore URL", "Competitor URL"):
+            df_out[col] = df_out[col].astype("category")
         st.dataframe(df_out)
 
         buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
             df_out.to_excel(writer, index=False, sheet_name="Comparison")
         st.download_button("📥 Download Results as Excel", data=buffer.getvalue(), file_name="price_comparison.xlsx")
     else: